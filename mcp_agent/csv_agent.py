@@ -3,7 +3,6 @@ import os
 from textwrap import dedent
 from typing import Optional
 import time
-import asyncio
 import traceback
 from dotenv import load_dotenv
 from langchain_openai import ChatOpenAI
@@ -16,8 +15,6 @@ load_dotenv()
 
 
 # Instructions for the CSV analysis agent
-from textwrap import dedent
-
 INSTRUCTIONS = dedent(
     """\
     You are a smart CSV data analyst assistant with access to CSV files through MCP tools.
@@ -79,10 +76,11 @@ async def run_agent(message: str, csv_path: str,tools) -> str:
         print("\nDiscovery failed:")
         print("".join(traceback.format_exception(type(e), e, e.__traceback__)))
         return
-    for tool in tools_by_server:
-        name = getattr(tool, "name", "<unknown>")
-        desc = (getattr(tool, "description", "") or "").strip()
-        print(f"- {name} :: {desc}")
+    if os.getenv("MCP_DEBUG"):
+        for tool in tools_by_server:
+            name = getattr(tool, "name", "<unknown>")
+            desc = (getattr(tool, "description", "") or "").strip()
+            print(f"- {name} :: {desc}")
 
     # Create OpenAI client
     llm = ChatGroq(model=MODEL_ID, api_key=MODEL_API_KEY)
@@ -1,11 +1,21 @@
 import asyncio
 import os
 import json
+import orjson
 from typing import TypedDict, Annotated
 from langchain_core.messages import BaseMessage, HumanMessage, AIMessage
 from textwrap import dedent
 from typing import Optional, Dict, Any
 import traceback
+import hashlib
+import weakref
+from functools import lru_cache
+import httpx
+import diskcache
+import polars as pl
+import sqlglot
+from jinja2 import Environment, FileSystemLoader
+from rapidfuzz import fuzz, process, utils
 from langchain_groq import ChatGroq
 from langgraph.prebuilt import create_react_agent
 from langchain_mcp_adapters.client import MultiServerMCPClient
@@ -13,6 +23,7 @@ from dotenv import load_dotenv
 from langgraph.errors import GraphRecursionError
 from langgraph.graph import StateGraph, END
 from langchain_core.tools import BaseTool
+from pydantic import BaseModel, ValidationError
 
 from langchain_mcp_adapters.tools import load_mcp_tools
 import logging
@@ -33,6 +44,11 @@ if not MODEL_API_KEY:
     raise ValueError("MODEL_API_KEY environment variable is not set.")
 
 
+def _jd(obj: Any) -> str:
+    """orjson-backed json.dumps for the request path (UTF-8, compact)."""
+    return orjson.dumps(obj).decode()
+
+
 # Visualization types mapping
 VISUALIZATION_TYPES = {
     "time_series": "Data that changes over time (sales trends, user growth)",
@@ -44,8 +60,12 @@ VISUALIZATION_TYPES = {
     "gauge": "KPIs with target values (sales goals, customer satisfaction)",
     "funnel": "Sequential process steps with drop-offs (sales funnel, user journey)",
 }
+# Canonical form so the system prompt is byte-identical across processes
+VISUALIZATION_TYPES_JSON = json.dumps(VISUALIZATION_TYPES, sort_keys=True, separators=(",", ":"))
 
 # --- OPTIMIZED INSTRUCTIONS WITH CLEAR STOPPING CONDITIONS ---
+# System prompts are fully static so the provider's prefix cache can reuse
+# their prefill across requests; per-request data only goes in the user turn.
 
 INSTRUCTIONS_CSV_ANALYSIS_AND_SCHEMA = dedent("""
 You are an expert data analyst. Your ONLY task is to analyze the provided CSV schema and return a JSON report.
@@ -92,7 +112,7 @@ JSON FORMAT (return ONLY this JSON, no extra text):
   ],
   "dashboard_components": ["filters", "charts", "tables"]
 }
-""") + "\n\nVisualization types: " + json.dumps(VISUALIZATION_TYPES)
+""") + "\n\nVisualization types: " + VISUALIZATION_TYPES_JSON
 INSTRUCTIONS_CSV_METRIC_DATA_JSON_ONLY = dedent("""\
 You are a data analyst. Execute SQL queries and return results in JSON format.
 
@@ -125,40 +145,57 @@ RETURN FORMAT (JSON only, no extra text):
 """)
 
 
-INSTRUCTIONS_RENDER_DASHBOARD_FROM_DATA = dedent("""
-You are a senior dashboard UI engineer.
-
-Input:
-- A JSON object containing an array `metrics`.
-- Each metric has:
-  - `metric` (string): the title,
-  - `description` (string): short explanation,
-  - `visualization_type` (string): one of `bar_chart`, `time_series`, `pie_chart`, or `table`,
-  - `data` (list of row objects): the data to display.
-
-Task:
-Generate a **complete, valid HTML document** that renders a responsive dashboard.
-
-Rules:
-1. Use Tailwind CSS (via CDN) for styling.
-2. Use Chart.js (via CDN) for `bar_chart`, `time_series`, and `pie_chart`.
-3. For `table`, render a styled Tailwind table.
-4. Each metric should appear in its own card:
-   - Card = rounded corners, shadow, padding, margin.
-   - Title and description at top.
-   - Visualization below.
-5. Layout must be mobile-friendly, clean, and centered (use Tailwind containers, `max-w-5xl mx-auto`).
-6. Ensure charts/tables auto-resize responsively and avoid horizontal overflow:
-   - Wrap each chart canvas inside a `div` with `w-full h-[400px]` (fixed height, responsive width).
-   - Add `max-w-full overflow-x-auto` for tables.
-   - Use `maintainAspectRatio: false` in Chart.js configs so charts stretch correctly.
-7. Avoid extra whitespace. Content should fit inside Streamlit `st.components.v1.html` without scrolling sideways.
-
-Output:
-Return only the HTML document string (no markdown, no explanations).
-""")
+# ─── DASHBOARD TEMPLATE ────────────────────────────────────────────────────────
 
-# ─── MCP INIT ──────────────────────────────────────────────────────────────────
+# visualization_type -> Chart.js chart type; anything else renders as a table
+CHART_JS_TYPES = {
+    "bar_chart": "bar",
+    "time_series": "line",
+    "pie_chart": "pie",
+    "scatter_plot": "scatter",
+}
+
+_TEMPLATE_ENV = Environment(
+    loader=FileSystemLoader(os.path.join(os.path.dirname(os.path.abspath(__file__)), "data")),
+    autoescape=True,
+)
+# tojson sorts keys by default; row column order decides the chart's label column
+_TEMPLATE_ENV.policies["json.dumps_kwargs"] = {"sort_keys": False}
+DASHBOARD_TEMPLATE = _TEMPLATE_ENV.get_template("dashboard.html.j2")
+
+# ─── LLM CLIENTS ───────────────────────────────────────────────────────────────
+
+# The metric spec itself is ~1K tokens, but reasoning models (the default
+# gpt-oss) spend hidden reasoning tokens against the same cap. Keep their
+# effort low and leave headroom so the spec is never truncated.
+SCHEMA_MAX_TOKENS = 4096
+_SCHEMA_REASONING = {"reasoning_effort": "low"} if MODEL_ID.startswith("openai/gpt-oss") else {}
+
+# One pooled HTTP/2 client per event loop, so TLS/TCP setup is paid once and
+# concurrent requests multiplex over the same connection. Pools are keyed by
+# loop because httpx connections are bound to the loop that opened them; with
+# main.py's persistent loop this is a single client per process.
+_SCHEMA_LLM_BY_LOOP: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, ChatGroq]" = weakref.WeakKeyDictionary()
+
+
+def _schema_llm() -> ChatGroq:
+    loop = asyncio.get_running_loop()
+    llm = _SCHEMA_LLM_BY_LOOP.get(loop)
+    if llm is None:
+        http_client = httpx.AsyncClient(
+            http2=True,
+            limits=httpx.Limits(max_keepalive_connections=20),
+            timeout=httpx.Timeout(120.0, connect=10.0),
+        )
+        # temperature=0 keeps the spec reproducible, which is what makes it cacheable
+        llm = ChatGroq(model=MODEL_ID, api_key=MODEL_API_KEY, temperature=0, max_tokens=SCHEMA_MAX_TOKENS, http_async_client=http_client, **_SCHEMA_REASONING)
+        _SCHEMA_LLM_BY_LOOP[loop] = llm
+    return llm
+
+# Schema-analysis specs persisted across runs and restarts. Entries are only
+# written by node_execute_sql once the spec's SQL has produced data.
+_SPEC_CACHE = diskcache.Cache(os.getenv("DASHBOARD_CACHE_DIR", "/tmp/dash_cache"))
+SPEC_CACHE_TTL = 24 * 3600
 
 # ─── MCP INIT ──────────────────────────────────────────────────────────────────
 
@@ -177,45 +214,199 @@ Return only the HTML document string (no markdown, no explanations).
 
 # ─── STATE GRAPH NODES ─────────────────────────────────────────────────────────
 
+class KeyMetric(BaseModel):
+    metric: str
+    description: str
+    visualization_type: str
+    visualization_rationale: Optional[str] = None
+    sql: str
+
+
+class MetricSpec(BaseModel):
+    domain: Optional[str] = None
+    key_metrics: list[KeyMetric]
+    dashboard_components: list[str]
+
+
 class PipelineState(TypedDict):
     messages: Annotated[list[BaseMessage], "add_messages"]
     csv_file_path: str
     tool:BaseTool
+    # execute_polars_sql tasks started by node_schema while the spec streams in
+    sql_tasks: list[asyncio.Task]
+    # Set when the spec came from the LLM; node_execute_sql caches it if it yields data
+    spec_cache_key: Optional[str]
 
 
-async def node_schema(state: PipelineState)->PipelineState:
-    try:
-        # 1) Load tools and locate get_schema
-        tools = state['tool']
-        get_schema = next((t for t in tools if t.name == "get_schema"), None)
-        if get_schema is None:
-            raise RuntimeError("get_schema tool not found")
-
-        # Optional: inspect the tool's input schema at runtime
-        # try:
-        #     logger.info(f"get_schema input schema: {getattr(get_schema, 'get_input_schema', None)}")
-        # except Exception:
-        #     pass  # Non-blocking
-
-        # 2) Invoke tool (expects file_location as a string)
-        wrapped = await get_schema.ainvoke({
-            "file_location": state['csv_file_path'],
-            "file_type": "csv"
-        })
-
+# Upper bound on concurrent execute_polars_sql calls against the MCP server
+SQL_CONCURRENCY = 10
 
 
+@lru_cache(maxsize=256)
+def _sql_parse_error(sql: str) -> Optional[str]:
+    """Parse locally (closest dialect to Polars SQL) so malformed queries never reach the MCP server."""
+    try:
+        sqlglot.parse_one(sql, read="duckdb")
+    except sqlglot.errors.SqlglotError as e:
+        return str(e)
+    return None
+
+def _normalize_rows(data: Any) -> list:
+    """Decode MCP text content item by item into row objects.
+
+    Handles both adapter result shapes: plain strings (0.1.x) and
+    ``{"type": "text", "text": ...}`` content blocks (0.2+).
+    """
+    if isinstance(data, str):
+        data = [data]
+    rows = []
+    for item in data or []:
+        if isinstance(item, dict) and item.get("type") == "text" and "text" in item:
+            item = item["text"]
+        if isinstance(item, str):
+            try:
+                item = orjson.loads(item)
+            except orjson.JSONDecodeError:
+                rows.append(item)
+                continue
+        if isinstance(item, list):
+            rows.extend(item)
+        else:
+            rows.append(item)
+    return rows
+
+async def _execute_metric_sql(exec_tool: BaseTool, csv_file_path: str, m: Dict[str, Any], sem: asyncio.Semaphore):
+    error = _sql_parse_error(m["sql"])
+    if error:
+        raise ValueError(f"Invalid SQL, skipped: {error}")
+    async with sem:
+        print(f"the query is {m['sql']}")
+        data = await exec_tool.ainvoke({
+            "file_locations": [csv_file_path],
+            "query": m["sql"],
+            "file_type": "csv"
+            })
+    return _normalize_rows(data)
+
+
+# Wide CSVs are trimmed to at most SCHEMA_MAX_COLUMNS columns: the best name
+# matches for the question first, then numeric columns, then the rest
+SCHEMA_MAX_COLUMNS = 40
+SCHEMA_MATCH_CUTOFF = 60
+_NUMERIC_DTYPE_PREFIXES = ("int", "uint", "float", "decimal")
+
+
+def _sample_schema_columns(schema_list: list[Dict[str, Any]], question: str, k: int = SCHEMA_MAX_COLUMNS) -> list[Dict[str, Any]]:
+    if len(schema_list) <= k:
+        return schema_list
+    matched = []
+    if question:
+        names = {i: str(col["name"]) for i, col in enumerate(schema_list)}
+        matched = [
+            idx for _, _, idx in process.extract(
+                question, names, scorer=fuzz.WRatio, processor=utils.default_process,
+                limit=k, score_cutoff=SCHEMA_MATCH_CUTOFF
+            )
+        ]
+    numeric = [
+        i for i, col in enumerate(schema_list)
+        if str(col["dtype"]).lower().startswith(_NUMERIC_DTYPE_PREFIXES)
+    ]
+    keep = set()
+    for i in [*matched, *numeric, *range(len(schema_list))]:
+        if len(keep) == k:
+            break
+        keep.add(i)
+    dropped = [col["name"] for i, col in enumerate(schema_list) if i not in keep]
+    logger.info(f"Schema sampled to {len(keep)}/{len(schema_list)} columns; dropped: {dropped}")
+    return [col for i, col in enumerate(schema_list) if i in keep]
+
+
+class _KeyMetricsStreamParser:
+    """Pull complete objects out of the "key_metrics" array while the LLM is still streaming it."""
+
+    def __init__(self):
+        self._buf = ""
+        self._pos = 0
+        self._in_array = False
+        self._done = False
+        self._depth = 0
+        self._start = 0
+        self._in_str = False
+        self._escape = False
+
+    def feed(self, text: str) -> list[Dict[str, Any]]:
+        self._buf += text
+        found = []
+        if self._done:
+            return found
+        if not self._in_array:
+            key = self._buf.find('"key_metrics"')
+            bracket = self._buf.find("[", key) if key != -1 else -1
+            if bracket == -1:
+                return found
+            self._in_array = True
+            self._pos = bracket + 1
+
+        buf = self._buf
+        i = self._pos
+        while i < len(buf):
+            ch = buf[i]
+            if self._in_str:
+                if self._escape:
+                    self._escape = False
+                elif ch == "\\":
+                    self._escape = True
+                elif ch == '"':
+                    self._in_str = False
+            elif ch == '"':
+                self._in_str = True
+            elif ch == "{":
+                if self._depth == 0:
+                    self._start = i
+                self._depth += 1
+            elif ch == "}":
+                self._depth -= 1
+                if self._depth == 0:
+                    try:
+                        found.append(orjson.loads(buf[self._start:i + 1]))
+                    except orjson.JSONDecodeError:
+                        logger.warning(f"Skipping unparsable streamed metric: {buf[self._start:i + 1][:200]}")
+            elif ch == "]" and self._depth == 0:
+                self._done = True
+                i += 1
+                break
+            i += 1
+        self._pos = i
+        return found
 
 
-        # 4) Call LLM to build the metric spec
-        llm = ChatGroq(model=MODEL_ID, api_key=MODEL_API_KEY)
-        try:
+async def node_schema(state: PipelineState)->PipelineState:
+    sql_tasks = []
+    try:
+        tools = state['tool']
+        csv_file_path = state['csv_file_path']
+        if os.path.isfile(csv_file_path):
+            # 1) Local file: polars infers names/dtypes from the header and a
+            #    small sample, no MCP round-trip needed
             schema_list = [
-                (json.loads(item) if isinstance(item, str) else item)
-                for item in wrapped
+                {"name": name, "dtype": str(dtype)}
+                for name, dtype in pl.scan_csv(csv_file_path).collect_schema().items()
             ]
-        except Exception as e:
-            raise ValueError(f"Failed to parse schema items: {e}")
+        else:
+            # 1) Not visible locally: ask the MCP server via get_schema
+            get_schema = next((t for t in tools if t.name == "get_schema"), None)
+            if get_schema is None:
+                raise RuntimeError("get_schema tool not found")
+
+            # 2) Invoke tool (expects file_location as a string)
+            wrapped = await get_schema.ainvoke({
+                "file_location": csv_file_path,
+                "file_type": "csv"
+            })
+
+            # 3) Normalize schema items (same content shapes as SQL results)
+            schema_list = _normalize_rows(wrapped)
 
         # Optional sanity checks (keep if you want defensive code)
         if not schema_list:
@@ -226,46 +417,66 @@ async def node_schema(state: PipelineState)->PipelineState:
         # Use schema_list directly with your instructions
         user_question = state['messages'][-1].content
         print(user_question)
+        # Schema before question keeps the prompt prefix shared across questions on
+        # the same CSV; for wide CSVs the sampled schema depends on the question
         llm_payload = {
-            "schema": schema_list,
+            "schema": _sample_schema_columns(schema_list, user_question),
             "question": user_question  # can be empty; the prompt must allow this
         }
 
-        # 5) Call LLM to build the metric spec
-        llm = ChatGroq(model=MODEL_ID, api_key=MODEL_API_KEY,max_tokens='10151')
-        analysis = await llm.ainvoke([
-            {"role": "system", "content": INSTRUCTIONS_CSV_ANALYSIS_AND_SCHEMA},
-            {"role": "user", "content": json.dumps(llm_payload, ensure_ascii=False)}
-        ])
-
-
-
-        if not hasattr(analysis, "content") or not analysis.content:
-            raise RuntimeError("LLM returned empty content for schema analysis.")
-
-        # 5) Parse spec JSON
-        try:
-            spec = json.loads(analysis.content)
-        except json.JSONDecodeError as je:
-            logger.error(f"LLM response not valid JSON: {analysis.content[:300]}...")
-            raise ValueError(f"Failed to parse analysis JSON: {je}") from je
-
-        # 6) Validate required keys
-        for k in ("key_metrics", "dashboard_components"):
-            if k not in spec:
-                raise ValueError(f"Analysis JSON missing required key: {k}")
-
-        minimal_spec = {
-        "key_metrics": spec.get("key_metrics", []),
-        "dashboard_components": spec.get("dashboard_components")
-    }
+        # 5) Same schema + question (+ model and prompt) yields the same spec;
+        #    on a hit node_execute_sql dispatches the SQL itself
+        cache_key = hashlib.sha256(
+            orjson.dumps([MODEL_ID, INSTRUCTIONS_CSV_ANALYSIS_AND_SCHEMA, llm_payload])
+        ).hexdigest()
+        minimal_spec = _SPEC_CACHE.get(cache_key)
+        spec_cache_key = None
+        if minimal_spec is not None:
+            logger.info(f"Schema spec cache hit: {cache_key[:12]}")
+        else:
+            spec_cache_key = cache_key
+            # Stream the metric spec from the LLM, dispatching each metric's SQL
+            # as soon as its object closes instead of waiting for the full spec
+            exec_tool = next((t for t in tools if t.name == "execute_polars_sql"), None)
+            sem = asyncio.Semaphore(SQL_CONCURRENCY)
+            parser = _KeyMetricsStreamParser()
+            content_parts = []
+            async for chunk in _schema_llm().astream([
+                {"role": "system", "content": INSTRUCTIONS_CSV_ANALYSIS_AND_SCHEMA},
+                {"role": "user", "content": _jd(llm_payload)}
+            ]):
+                if not chunk.content:
+                    continue
+                content_parts.append(chunk.content)
+                if exec_tool is None:
+                    continue
+                for m in parser.feed(chunk.content):
+                    sql_tasks.append(asyncio.create_task(
+                        _execute_metric_sql(exec_tool, state['csv_file_path'], m, sem)
+                    ))
+            content = "".join(content_parts)
+
+            if not content:
+                raise RuntimeError("LLM returned empty content for schema analysis.")
+
+            # 6) Parse and validate the spec in one pass
+            try:
+                spec = MetricSpec.model_validate_json(content)
+            except ValidationError as ve:
+                logger.error(f"LLM response not a valid spec: {content[:300]}...")
+                raise ValueError(f"Failed to parse analysis JSON: {ve}") from ve
+            minimal_spec = spec.model_dump(include={"key_metrics", "dashboard_components"})
         return {
         "messages": [
-        AIMessage(content=json.dumps(minimal_spec, ensure_ascii=False))
-    ]
+        AIMessage(content=_jd(minimal_spec))
+    ],
+        "sql_tasks": sql_tasks,
+        "spec_cache_key": spec_cache_key
 }
 
     except Exception as e:
+        for t in sql_tasks:
+            t.cancel()
         logger.error(f"node_schema failed: {e}")
         # Return a structured error so the graph can decide how to proceed
         return {
@@ -285,38 +496,91 @@ async def node_execute_sql(state: PipelineState)->PipelineState:
     results = []
     messages=state['messages'][-1]
     try:
-        payload = json.loads(messages.content)
+        payload = orjson.loads(messages.content)
     except Exception as e:
         raise ValueError(f"Failed to parse AIMessage content as JSON: {e}")
     key_metrics = payload.get("key_metrics", [])
-    for m in key_metrics:
-        print(f"the query is {m['sql']}")
-        data = await exec_tool.ainvoke({
-            "file_locations": [state['csv_file_path']],
-            "query": m["sql"],
-            "file_type": "csv"
-            })
+    sql_tasks = state.get('sql_tasks') or []
+    if len(sql_tasks) != len(key_metrics):
+        # Streamed dispatch did not line up with the final spec; run every query here
+        for t in sql_tasks:
+            t.cancel()
+        sem = asyncio.Semaphore(SQL_CONCURRENCY)
+        sql_tasks = [
+            asyncio.create_task(_execute_metric_sql(exec_tool, state['csv_file_path'], m, sem))
+            for m in key_metrics
+        ]
+    datas = await asyncio.gather(*sql_tasks, return_exceptions=True)
+    working_metrics = []
+    for m, data in zip(key_metrics, datas):
+        if isinstance(data, Exception):
+            logger.error(f"SQL for metric {m.get('metric')!r} failed: {data}")
+            continue
+        # Empty results would only render as blank cards
+        if not data:
+            logger.info(f"Dropping metric {m.get('metric')!r}: query returned no rows")
+            continue
+        working_metrics.append(m)
         results.append({
             "metric": m["metric"],
             "description": m["description"],
             "visualization_type": m["visualization_type"],
-            "data": data or []
+            "data": data
         })
 
+    # Cache a fresh spec only once it is known to produce data, and only the
+    # metrics that did, so a bad spec is not replayed on every retry
+    spec_cache_key = state.get('spec_cache_key')
+    if spec_cache_key and working_metrics:
+        _SPEC_CACHE.set(spec_cache_key, {
+            "key_metrics": working_metrics,
+            "dashboard_components": payload.get("dashboard_components")
+        }, expire=SPEC_CACHE_TTL)
+
     return {
         'messages': [AIMessage(content=results)]}
 
+def _is_number(value: Any) -> bool:
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+def _prepare_card(m: Dict[str, Any]) -> Dict[str, Any]:
+    """Decide how a metric card renders.
+
+    ``columns`` is set only when every row is a mapping (otherwise rows are
+    shown as a one-column table). ``chart_type`` is set only when the data can
+    actually be plotted, together with ``label_key`` (labels, or x for scatter)
+    and ``value_keys`` (one dataset each, or y for scatter):
+
+    - category charts need a numeric column after the first (label) column;
+    - scatter needs two numeric columns, since both axes are linear.
+
+    Anything else falls back to a table.
+    """
+    rows = m.get("data") or []
+    columns = list(rows[0]) if rows and all(isinstance(r, dict) for r in rows) else None
+    chart_type = CHART_JS_TYPES.get(m.get("visualization_type"))
+    label_key, value_keys = None, []
+    if chart_type and columns:
+        numeric = [c for c in columns if all(r.get(c) is None or _is_number(r.get(c)) for r in rows)]
+        if chart_type == "scatter":
+            if len(numeric) >= 2:
+                label_key, value_keys = numeric[0], numeric[1:2]
+        else:
+            label_key, value_keys = columns[0], [c for c in numeric if c != columns[0]]
+    if not value_keys:
+        chart_type, label_key = None, None
+    return {**m, "columns": columns, "chart_type": chart_type, "label_key": label_key, "value_keys": value_keys}
+
+
 async def node_render_html(state: PipelineState)->PipelineState:
 
     messages=state['messages'][-1]
 
     last_messages=messages.content
-    llm = ChatGroq(model=MODEL_ID, api_key=MODEL_API_KEY)
-    html_resp = await llm.ainvoke([
-        {"role": "system", "content": INSTRUCTIONS_RENDER_DASHBOARD_FROM_DATA},
-        {"role": "user", "content": json.dumps({"metrics": last_messages})}
-    ])
-    return {"messages": [AIMessage(content=html_resp.content)]}
+    # The layout is fully determined by the metrics, so it is templated locally
+    html = DASHBOARD_TEMPLATE.render(metrics=[_prepare_card(m) for m in last_messages])
+    return {"messages": [AIMessage(content=html)]}
 
 # ─── BUILD & RUN GRAPH ────────────────────────────────────────────────────────
 
@@ -1,26 +1,75 @@
 import os
+import json
+import time
+import shutil
 import asyncio
+import threading
 import streamlit as st
 from langchain_core.messages import HumanMessage, AIMessage
 from langchain_mcp_adapters.client import MultiServerMCPClient
+from langchain_mcp_adapters.tools import convert_mcp_tool_to_langchain_tool
+from mcp.types import Tool
 # Import your compiled graph builder
 from dashboard_agent import build_pipeline_graph
 CUSTOM_TEMP_DIR = "/mnt/c/workspaces/mcpserver/temp/"
 os.makedirs(CUSTOM_TEMP_DIR, exist_ok=True)
+# One event loop per process, running on a daemon thread, so HTTP pools and
+# MCP transports created inside coroutines survive across reruns and clicks
+@st.cache_resource
+def get_event_loop():
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, name="async-loop", daemon=True).start()
+    return loop
+
 # Simple async runner for Streamlit
 def run_async(coro):
-    try:
-        loop = asyncio.get_event_loop()
-    except RuntimeError:
-        loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(loop)
-    return loop.run_until_complete(coro)
+    return asyncio.run_coroutine_threadsafe(coro, get_event_loop()).result()
 
 CSV_MCP_SERVER = {"csv_analyst": {"url": "http://localhost:8050/sse", "transport": "sse",}}
 
+# Discovered tool descriptors are persisted so a restart skips the SSE handshake
+MCP_TOOLS_CACHE_PATH = os.path.expanduser("~/.cache/mcp_tools.json")
+MCP_TOOLS_CACHE_TTL = 3600
+
+def load_cached_tool_descriptors():
+    try:
+        with open(MCP_TOOLS_CACHE_PATH, "r", encoding="utf-8") as f:
+            cached = json.load(f)
+    except (OSError, ValueError):
+        return None
+    # Anything but the object written by save_tool_descriptors is a miss
+    if not isinstance(cached, dict) or not isinstance(cached.get("tools"), list):
+        return None
+    saved_at = cached.get("saved_at")
+    if not isinstance(saved_at, (int, float)) or time.time() - saved_at > MCP_TOOLS_CACHE_TTL:
+        return None
+    return cached["tools"]
+
+def save_tool_descriptors(tools):
+    descriptors = []
+    for t in tools:
+        schema = t.args_schema if isinstance(t.args_schema, dict) else t.args_schema.model_json_schema()
+        descriptors.append({"name": t.name, "description": t.description, "inputSchema": schema})
+    try:
+        os.makedirs(os.path.dirname(MCP_TOOLS_CACHE_PATH), exist_ok=True)
+        with open(MCP_TOOLS_CACHE_PATH, "w", encoding="utf-8") as f:
+            json.dump({"saved_at": time.time(), "tools": descriptors}, f)
+    except OSError as e:
+        print(f"Could not persist MCP tool cache: {e}")
+
+@st.cache_resource(ttl=MCP_TOOLS_CACHE_TTL)
 def init_mcp_tools():
+    descriptors = load_cached_tool_descriptors()
+    if descriptors:
+        # Same connection-backed tools get_tools() returns, minus the discovery round-trip
+        connection = CSV_MCP_SERVER["csv_analyst"]
+        return [
+            convert_mcp_tool_to_langchain_tool(None, Tool(**d), connection=connection)
+            for d in descriptors
+        ]
     client = MultiServerMCPClient(CSV_MCP_SERVER)
-    tools_by_server = asyncio.run(client.get_tools())
+    tools_by_server = run_async(client.get_tools())
+    save_tool_descriptors(tools_by_server)
     return tools_by_server
 
 # Initialize once in session_state
@@ -30,6 +79,10 @@ if "mcp_tools" not in st.session_state:
 # Usage
 tool = st.session_state.mcp_tools
 
+# Compile the graph once per session instead of on every click
+if "pipeline" not in st.session_state:
+    st.session_state.pipeline = build_pipeline_graph()
+
 
 st.set_page_config(page_title="CSV → Dashboard", layout="wide")
 st.title("CSV → Dashboard (Simple)")
@@ -42,9 +95,17 @@ csv_path = None
 if csv_file is not None:
     # Persist to a temp path
 
-    csv_path = os.path.join(CUSTOM_TEMP_DIR, f"uploaded_{csv_file.name}")
-    with open(csv_path, "wb") as f:
-        f.write(csv_file.getbuffer())
+    # file_id in the name keeps uploads from different sessions (or a re-upload
+    # with the same name) from sharing one path
+    csv_path = os.path.join(CUSTOM_TEMP_DIR, f"uploaded_{csv_file.file_id}_{csv_file.name}")
+    # Streamlit reruns the script on every interaction; write each upload only once
+    upload_key = (csv_file.file_id, csv_path)
+    if st.session_state.get("persisted_upload") != upload_key or not os.path.exists(csv_path):
+        with open(csv_path, "wb") as f:
+            # Copy in 1MB chunks rather than materializing the whole upload again
+            shutil.copyfileobj(csv_file, f, length=1024 * 1024)
+        csv_file.seek(0)
+        st.session_state.persisted_upload = upload_key
     st.success(f"Uploaded: {csv_file.name}")
 
 # 2) Enter a question/prompt
@@ -59,8 +120,7 @@ if st.button("Generate Dashboard"):
     else:
         with st.spinner("Generating dashboard..."):
             try:
-                # Build pipeline
-                pipeline = build_pipeline_graph()
+                pipeline = st.session_state.pipeline
 
                 # Initial state: messages + csv_file_path
                 init_state = {